@@ -1,10 +1,16 @@
 # easyfairs_widgets.py
 from __future__ import annotations
 
-from typing import Any, Dict, List, Optional, Tuple
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
 import re
+
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # =========================================================
 # 1) Mapping dominio -> containerId
@@ -20,22 +26,27 @@ EASYFAIRS_CONTAINER_MAP: Dict[str, int] = {
 # =========================================================
 def is_easyfairs_supported(event_url: str) -> bool:
     """
-    Devuelve True si el dominio está en el mapping.
+    Devuelve True si la URL trae containerId en la query o el dominio está en
+    el mapping (misma regla que get_container_id_for_url).
     """
-    try:
-        host = (urlparse(event_url).netloc or "").lower()
-    except Exception:
-        return False
-    if not host:
-        return False
-    return host in EASYFAIRS_CONTAINER_MAP
+    return get_container_id_for_url(event_url) is not None
 
 
+@lru_cache(maxsize=1024)
 def get_container_id_for_url(event_url: str) -> Optional[int]:
     try:
-        host = (urlparse(event_url).netloc or "").lower()
+        parsed = urlparse(event_url)
     except Exception:
         return None
+
+    # Si la URL ya trae el containerId en la query, no hace falta el mapping
+    qs = parse_qs(parsed.query)
+    for key in ("containerId", "container_id"):
+        val = (qs.get(key) or [""])[0].strip()
+        if val.isdigit():
+            return int(val)
+
+    host = (parsed.netloc or "").lower()
     return EASYFAIRS_CONTAINER_MAP.get(host)
 
 # =========================================================
@@ -51,12 +62,50 @@ DEFAULT_HEADERS = {
     "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
 }
 
+# Tope a la espera de un Retry-After (429/503): respetamos el rate limit del
+# servidor, pero sin dejar un hilo del threadpool bloqueado indefinidamente.
+_RETRY_AFTER_MAX_S = 5.0
+
+
+class _CappedRetry(Retry):
+    def get_retry_after(self, response: Any) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, _RETRY_AFTER_MAX_S)
+
+
+# Sesión compartida entre scrapes: reutiliza las conexiones keep-alive (TLS)
+# con my.easyfairs.com en lugar de abrir un pool nuevo en cada llamada.
+# La consulta de stands es idempotente: reintentamos POST ante errores de
+# conexión y 429/5xx transitorios. Nunca tras un read timeout (read=0): una
+# llamada colgada no debe costar varias veces timeout_s.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=_CappedRetry(
+            total=3,
+            read=0,
+            backoff_factor=0.3,
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False,
+        ),
+    ),
+)
+
 _url_re = re.compile(r"(https?://[^\s)]+|www\.[^\s)]+)", re.IGNORECASE)
 
 
 def _extract_website_from_text(text: str) -> str:
     if not text:
         return ""
+    # Filtro barato antes del regex: la mayoría de descripciones no llevan URL
+    if "://" not in text and "www." not in text.lower():
+        return ""
     m = _url_re.search(text)
     if not m:
         return ""
@@ -67,32 +116,155 @@ def _extract_website_from_text(text: str) -> str:
 
 
 def _activity_from_hit(hit: Dict[str, Any], lang: str) -> str:
-    cats = hit.get("categories") or []
-    names: List[str] = []
+    # dict.fromkeys: dedupe manteniendo orden, sin lista intermedia
+    return ", ".join(dict.fromkeys(_category_names(hit.get("categories") or [], lang)))
+
+
+def _category_names(cats: List[Dict[str, Any]], lang: str) -> Iterator[str]:
     for c in cats:
-        nm = (c.get("name") or {}).get(lang) or (c.get("name") or {}).get("en") or ""
-        nm = (nm or "").strip()
+        label = c.get("name") or {}
+        nm = (label.get(lang) or label.get("en") or "").strip()
         if nm:
-            names.append(nm)
-
-    # dedupe manteniendo orden
-    seen = set()
-    out: List[str] = []
-    for n in names:
-        if n not in seen:
-            seen.add(n)
-            out.append(n)
-    return ", ".join(out)
+            yield nm
 
 
 def _build_algolia_filters(container_id: int, country: Optional[str]) -> str:
     base = f"(containerId: {container_id})"
     if country:
-        base += f' AND country:"{country}"'
+        # Escapamos \ y " para que un nombre de país no rompa la expresión
+        value = country.replace("\\", "\\\\").replace('"', '\\"')
+        base += f' AND country:"{value}"'
     return base
 
 
-def fetch_easyfairs_stands_by_countries(
+# Páginas pedidas por POST: el endpoint acepta varias queries en el mismo
+# payload (formato multi-query de Algolia) y devuelve un bloque por query.
+_PAGES_PER_BATCH = 5
+
+# Países en paralelo (Spain/Portugal por defecto): comparten el pool de _SESSION
+_COUNTRY_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="easyfairs")
+
+
+def _stands_params(filters: str, hits_per_page: int, query_seed: str) -> Dict[str, Any]:
+    # Parámetros fijos para todas las páginas de un país: se construyen una vez
+    return {
+        "facets": ["categories.name", "country"],
+        "filters": filters,
+        "highlightPostTag": "__/ais-highlight__",
+        "highlightPreTag": "__ais-highlight__",
+        "hitsPerPage": int(hits_per_page),
+        "maxValuesPerFacet": 100,
+        "query": str(query_seed),
+    }
+
+
+def _stands_query(base_params: Dict[str, Any], page: int) -> Dict[str, Any]:
+    return {
+        "indexName": "stands_relevance",
+        "params": {**base_params, "page": int(page)},
+    }
+
+
+def _post_stands_queries(endpoint: str, queries: List[Dict[str, Any]], timeout_s: int) -> List[Dict[str, Any]]:
+    # Codificamos con orjson (content-type ya va en DEFAULT_HEADERS)
+    r = _SESSION.post(
+        endpoint,
+        data=orjson.dumps(queries),
+        headers=DEFAULT_HEADERS,
+        timeout=timeout_s,
+    )
+
+    if r.status_code >= 400:
+        body_preview = (r.text or "")[:800]
+        raise RuntimeError(f"Easyfairs widgets HTTP {r.status_code}. Body: {body_preview}")
+
+    data = orjson.loads(r.content) or {}
+    return data.get("results") or []
+
+
+def _fetch_country_pages(
+    endpoint: str,
+    base_params: Dict[str, Any],
+    country: str,
+    lang: str,
+    timeout_s: int,
+    max_pages: Optional[int],
+) -> Optional[Tuple[int, List[List[Dict[str, Any]]]]]:
+    """
+    Descarga las páginas de un país: (nbHits, stands compactos de cada página
+    en orden, sin deduplicar). El JSON de cada página se descarta en cuanto se
+    convierte. None si el endpoint no devuelve resultados para la primera página.
+    """
+    # Página 0: además de hits, nos dice cuántas páginas hay
+    results = _post_stands_queries(endpoint, [_stands_query(base_params, 0)], timeout_s)
+    if not results:
+        return None
+
+    block = results[0]
+    nb_hits = int(block.get("nbHits") or 0)
+    nb_pages = int(block.get("nbPages") or 0)
+    pages_stands = [_stands_from_hits(block.get("hits") or [], country, lang)]
+
+    # Resto de páginas en lotes: un round-trip por cada _PAGES_PER_BATCH
+    last_page = nb_pages if max_pages is None else min(nb_pages, max_pages)
+    for first in range(1, last_page, _PAGES_PER_BATCH):
+        pages = range(first, min(first + _PAGES_PER_BATCH, last_page))
+        results = _post_stands_queries(
+            endpoint,
+            [_stands_query(base_params, p) for p in pages],
+            timeout_s,
+        )
+        if not results:
+            break
+        if len(results) != len(pages):
+            # El endpoint no devolvió un bloque por query: no sabemos a qué
+            # página corresponde cada uno, así que pedimos el lote página a página
+            results = []
+            for p in pages:
+                single = _post_stands_queries(endpoint, [_stands_query(base_params, p)], timeout_s)
+                if not single:
+                    break
+                results.append(single[0])
+            if not results:
+                break
+
+        pages_stands.extend(
+            _stands_from_hits(block.get("hits") or [], country, lang) for block in results
+        )
+        if len(results) != len(pages):
+            break
+
+    return nb_hits, pages_stands
+
+
+def _stands_from_hits(
+    hits: List[Dict[str, Any]],
+    country: str,
+    lang: str,
+) -> List[Dict[str, Any]]:
+    out: List[Dict[str, Any]] = []
+    for hit in hits:
+        get = hit.get
+        website = (get("website") or "").strip()
+
+        if not website:
+            desc = get("description") or {}
+            desc_text = (desc.get(lang) or desc.get("en") or "").strip()
+            website = _extract_website_from_text(desc_text)
+
+        out.append(
+            {
+                "objectID": get("objectID"),
+                "name": (get("name") or "").strip(),
+                "activity": _activity_from_hit(hit, lang=lang),
+                "website": website,
+                "country": (get("country") or "").strip() or country,
+            }
+        )
+    return out
+
+
+def iter_easyfairs_stands_by_countries(
     event_url: str,
     container_id: int,
     countries: List[str],
@@ -101,111 +273,99 @@ def fetch_easyfairs_stands_by_countries(
     hits_per_page: int = 100,
     timeout_s: int = 25,
     max_pages: Optional[int] = 20,
-) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    meta: Optional[Dict[str, Any]] = None,
+    on_empty_first_page: Optional[Callable[[], None]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Genera los stands (ya deduplicados) país a país según van terminando sus
+    descargas, que corren en paralelo. Si se pasa `meta`, se rellena durante
+    la iteración. `on_empty_first_page` se llama si la primera página del
+    primer país vuelve sin hits (aviso temprano de que puede no haber datos).
+    """
     if not countries:
         countries = ["Spain", "Portugal"]
 
     endpoint = EASYFAIRS_WIDGETS_ENDPOINT.format(lang=lang)
 
-    rows: List[Dict[str, Any]] = []
+    # dedupe por objectID manteniendo orden, al vuelo (sin segunda lista)
+    seen = set()
     hits_reported_by_country: Dict[str, int] = {}
     pages_fetched_by_country: Dict[str, int] = {}
 
-    session = requests.Session()
-
-    for country in countries:
-        page = 0
-        fetched_pages = 0
-
-        while True:
-            if max_pages is not None and fetched_pages >= max_pages:
-                break
-
-            payload = [
-                {
-                    "indexName": "stands_relevance",
-                    "params": {
-                        "facets": ["categories.name", "country"],
-                        "filters": _build_algolia_filters(container_id, country),
-                        "highlightPostTag": "__/ais-highlight__",
-                        "highlightPreTag": "__ais-highlight__",
-                        "hitsPerPage": int(hits_per_page),
-                        "maxValuesPerFacet": 100,
-                        "page": int(page),
-                        "query": str(query_seed),
-                    },
-                }
-            ]
-
-            r = session.post(
-                endpoint,
-                json=payload,
-                headers=DEFAULT_HEADERS,
-                timeout=timeout_s,
-            )
-
-            if r.status_code >= 400:
-                body_preview = (r.text or "")[:800]
-                raise RuntimeError(f"Easyfairs widgets HTTP {r.status_code}. Body: {body_preview}")
-
-            data = r.json() or {}
-            results = data.get("results") or []
-            if not results:
-                break
+    if meta is not None:
+        meta.update(
+            {
+                "source": "easyfairs_widgets",
+                "container_id": container_id,
+                "language": lang,
+                "query_seed": query_seed,
+                "countries": countries,
+                "hits_reported_by_country": hits_reported_by_country,
+                "pages_fetched_by_country": pages_fetched_by_country,
+                "dedupe_by_objectID": True,
+            }
+        )
+
+    if max_pages is not None and max_pages <= 0:
+        return
+
+    # Un país por hilo (las llamadas HTTP se solapan); cada hilo guarda solo
+    # stands compactos. El dedupe y el orden de salida siguen los de `countries`
+    futures = [
+        _COUNTRY_EXECUTOR.submit(
+            _fetch_country_pages,
+            endpoint,
+            _stands_params(_build_algolia_filters(container_id, country), hits_per_page, query_seed),
+            country,
+            lang,
+            timeout_s,
+            max_pages,
+        )
+        for country in countries
+    ]
+
+    for i, (country, future) in enumerate(zip(countries, futures)):
+        fetched = future.result()
+        if i == 0 and on_empty_first_page is not None and (fetched is None or not fetched[0]):
+            on_empty_first_page()
+        if fetched is None:
+            continue
 
-            block = results[0]
-            nb_hits = int(block.get("nbHits") or 0)
-            nb_pages = int(block.get("nbPages") or 0)
-            hits_reported_by_country[country] = nb_hits
-
-            hits = block.get("hits") or []
-            for hit in hits:
-                name = (hit.get("name") or "").strip()
-                ctry = (hit.get("country") or "").strip() or country
-                activity = _activity_from_hit(hit, lang=lang)
-                website = (hit.get("website") or "").strip()
-
-                if not website:
-                    desc = hit.get("description") or {}
-                    desc_text = (desc.get(lang) or desc.get("en") or "").strip()
-                    website = _extract_website_from_text(desc_text)
-
-                rows.append(
-                    {
-                        "objectID": hit.get("objectID"),
-                        "name": name,
-                        "activity": activity,
-                        "website": website,
-                        "country": ctry,
-                    }
-                )
-
-            fetched_pages += 1
+        nb_hits, pages_stands = fetched
+        hits_reported_by_country[country] = nb_hits
+        for fetched_pages, stands in enumerate(pages_stands, 1):
+            for stand in stands:
+                oid = stand["objectID"]
+                key = oid if oid is not None else (stand["name"], stand["country"])
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield stand
             pages_fetched_by_country[country] = fetched_pages
 
-            page += 1
-            if nb_pages <= 0 or page >= nb_pages:
-                break
 
-    # dedupe por objectID manteniendo orden
-    seen = set()
-    deduped: List[Dict[str, Any]] = []
-    for r in rows:
-        oid = r.get("objectID")
-        key = oid if oid is not None else (r.get("name"), r.get("country"))
-        if key in seen:
-            continue
-        seen.add(key)
-        deduped.append(r)
-
-    meta = {
-        "source": "easyfairs_widgets",
-        "container_id": container_id,
-        "language": lang,
-        "query_seed": query_seed,
-        "countries": countries,
-        "hits_reported_by_country": hits_reported_by_country,
-        "pages_fetched_by_country": pages_fetched_by_country,
-        "dedupe_by_objectID": True,
-    }
-    return deduped, meta
+def fetch_easyfairs_stands_by_countries(
+    event_url: str,
+    container_id: int,
+    countries: List[str],
+    lang: str = "es",
+    query_seed: str = "a",
+    hits_per_page: int = 100,
+    timeout_s: int = 25,
+    max_pages: Optional[int] = 20,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    meta: Dict[str, Any] = {}
+    rows = list(
+        iter_easyfairs_stands_by_countries(
+            event_url=event_url,
+            container_id=container_id,
+            countries=countries,
+            lang=lang,
+            query_seed=query_seed,
+            hits_per_page=hits_per_page,
+            timeout_s=timeout_s,
+            max_pages=max_pages,
+            meta=meta,
+        )
+    )
+    return rows, meta
@@ -1,22 +1,49 @@
 # main.py
 from __future__ import annotations
 
-from typing import Any, Dict, List, Optional
+import asyncio
+import warnings
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
 
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import Response, JSONResponse
+from fastapi.responses import Response, ORJSONResponse
 from pydantic import BaseModel, Field, HttpUrl
 
 from io import BytesIO
 from openpyxl import Workbook
-from openpyxl.worksheet.table import Table, TableStyleInfo
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.worksheet.filters import AutoFilter
+from openpyxl.worksheet.table import Table, TableColumn, TableStyleInfo
 from openpyxl.styles import Font, Alignment
 from openpyxl.utils import get_column_letter
 
 from scrapers import ScrapeConfig, scrape_any, normalize_countries
+from playwright_scraper import shutdown_playwright
+
+# add_table avisa siempre en write-only aunque las columnas ya vayan a mano
+# (ver _build_excel). Filtro global y acotado a ese mensaje: catch_warnings no
+# es thread-safe y los endpoints corren en el threadpool.
+warnings.filterwarnings(
+    "ignore",
+    message="In write-only mode you must add table columns manually",
+    category=UserWarning,
+)
+
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Chromium se lanza perezosamente y se reutiliza; lo cerramos al apagar
+    await asyncio.to_thread(shutdown_playwright)
 
-app = FastAPI(title="Fair Scraper API", version="2.0.0")
+
+app = FastAPI(
+    title="Fair Scraper API",
+    version="2.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 
 class ScrapeRequest(BaseModel):
@@ -25,6 +52,7 @@ class ScrapeRequest(BaseModel):
     max_pages: int = 20
     timeout_ms: int = 25000
     debug: bool = False
+    container_id: Optional[int] = None  # containerId Easyfairs si ya se conoce
 
 
 class Company(BaseModel):
@@ -46,10 +74,22 @@ def health():
     return {"status": "ok"}
 
 
+def _header_row(ws, values: List[str], font: Font, alignment: Optional[Alignment] = None) -> List[WriteOnlyCell]:
+    cells = []
+    for v in values:
+        cell = WriteOnlyCell(ws, value=v)
+        cell.font = font
+        if alignment is not None:
+            cell.alignment = alignment
+        cells.append(cell)
+    return cells
+
+
 def _build_excel(results: List[Dict[str, Any]], url: str, meta: Dict[str, Any]) -> bytes:
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Empresas"
+    # Modo write-only: las filas se vuelcan en streaming sin mantener un objeto
+    # Cell por celda. Anchos y freeze panes se fijan ANTES del primer append.
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Empresas")
 
     # ---- ORDENAR POR PAÍS Y FABRICANTE ----
     sorted_results = sorted(
@@ -61,28 +101,42 @@ def _build_excel(results: List[Dict[str, Any]], url: str, meta: Dict[str, Any])
     )
 
     headers = ["Fabricante", "Actividad", "Enlace Web", "País"]
-    ws.append(headers)
 
-    # ---- Estilo cabecera ----
+    # ---- Preparar filas (midiendo el ancho de columnas en la misma pasada) ----
+    widths = [len(h) for h in headers]
+    rows: List[List[Any]] = []
+    for item in sorted_results:
+        row_vals = [
+            item.get("fabricante", ""),
+            item.get("actividad", ""),
+            item.get("enlace_web", ""),
+            item.get("pais", ""),
+        ]
+        for i, val in enumerate(row_vals):
+            if val:
+                n = len(str(val))
+                if n > widths[i]:
+                    widths[i] = n
+        rows.append(row_vals)
+
+    # ---- Auto ancho columnas ----
+    for col, max_len in enumerate(widths, 1):
+        ws.column_dimensions[get_column_letter(col)].width = min(max_len + 3, 60)
+
+    # ---- Freeze panes ----
+    ws.freeze_panes = "A2"
+
+    # ---- Cabecera con estilo ----
     header_font = Font(bold=True)
-    for col in range(1, len(headers) + 1):
-        cell = ws.cell(row=1, column=col)
-        cell.font = header_font
-        cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+    header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+    ws.append(_header_row(ws, headers, header_font, header_alignment))
 
     # ---- Insertar datos ----
-    for item in sorted_results:
-        ws.append(
-            [
-                item.get("fabricante", ""),
-                item.get("actividad", ""),
-                item.get("enlace_web", ""),
-                item.get("pais", ""),
-            ]
-        )
+    for row_vals in rows:
+        ws.append(row_vals)
 
-    last_row = ws.max_row
-    last_col = ws.max_column
+    last_row = len(rows) + 1
+    last_col = len(headers)
 
     # ---- Convertir en TABLA estructurada ----
     table_ref = f"A1:{get_column_letter(last_col)}{last_row}"
@@ -96,26 +150,14 @@ def _build_excel(results: List[Dict[str, Any]], url: str, meta: Dict[str, Any])
         showColumnStripes=False,
     )
     table.tableStyleInfo = style
+    # En write-only openpyxl no puede leer la cabecera: columnas y filtro a mano
+    table.tableColumns = [TableColumn(id=i, name=h) for i, h in enumerate(headers, 1)]
+    table.autoFilter = AutoFilter(ref=table_ref)
     ws.add_table(table)
 
-    # ---- Freeze panes ----
-    ws.freeze_panes = "A2"
-
-    # ---- Auto ancho columnas ----
-    for col in range(1, last_col + 1):
-        max_len = 0
-        col_letter = get_column_letter(col)
-        for row in range(1, last_row + 1):
-            val = ws.cell(row=row, column=col).value
-            if val:
-                max_len = max(max_len, len(str(val)))
-        ws.column_dimensions[col_letter].width = min(max_len + 3, 60)
-
     # ---- Hoja meta ----
     ws2 = wb.create_sheet("Meta")
-    ws2.append(["Campo", "Valor"])
-    ws2["A1"].font = header_font
-    ws2["B1"].font = header_font
+    ws2.append(_header_row(ws2, ["Campo", "Valor"], header_font))
     ws2.append(["URL", url])
     ws2.append(["Total empresas", str(len(sorted_results))])
 
@@ -128,8 +170,11 @@ def _build_excel(results: List[Dict[str, Any]], url: str, meta: Dict[str, Any])
     return bio.getvalue()
 
 
-@app.post("/scrape_json", response_model=ScrapeResponse)
-def scrape_json(req: ScrapeRequest):
+def _run_scrape(req: ScrapeRequest) -> Tuple[str, List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Lógica común de /scrape_json y /scrape: lanza los drivers y falla con 400
+    si ninguno devuelve expositores.
+    """
     url = str(req.url)
 
     countries_norm = normalize_countries(req.countries)
@@ -138,6 +183,7 @@ def scrape_json(req: ScrapeRequest):
         timeout_s=max(5, int(req.timeout_ms / 1000)),
         max_pages=req.max_pages,
         debug=req.debug,
+        container_id=req.container_id,
     )
 
     results, meta = scrape_any(url, cfg)
@@ -151,7 +197,17 @@ def scrape_json(req: ScrapeRequest):
             },
         )
 
-    return ScrapeResponse(url=url, total=len(results), results=results, meta=meta)
+    return url, results, meta
+
+
+@app.post("/scrape_json", response_model=ScrapeResponse)
+def scrape_json(req: ScrapeRequest):
+    url, results, meta = _run_scrape(req)
+
+    # Las filas las construyen nuestros drivers: devolvemos la respuesta ya
+    # serializada para que FastAPI no las revalide contra response_model
+    # (que se mantiene para documentar el esquema en OpenAPI).
+    return ORJSONResponse({"url": url, "total": len(results), "results": results, "meta": meta})
 
 
 @app.post(
@@ -162,26 +218,7 @@ def scrape_json(req: ScrapeRequest):
     },
 )
 def scrape_excel(req: ScrapeRequest):
-    url = str(req.url)
-
-    countries_norm = normalize_countries(req.countries)
-    cfg = ScrapeConfig(
-        countries=countries_norm,
-        timeout_s=max(5, int(req.timeout_ms / 1000)),
-        max_pages=req.max_pages,
-        debug=req.debug,
-    )
-
-    results, meta = scrape_any(url, cfg)
-
-    if not results:
-        raise HTTPException(
-            status_code=400,
-            detail={
-                "message": "No se pudo extraer ningún expositor con los drivers disponibles.",
-                "meta": meta,
-            },
-        )
+    url, results, meta = _run_scrape(req)
 
     xlsx = _build_excel(results=results, url=url, meta=meta)
     filename = "fabricantes.xlsx"
@@ -191,23 +228,3 @@ def scrape_excel(req: ScrapeRequest):
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
-    # ---- Hoja Resumen Comercial ----
-    ws3 = wb.create_sheet("Resumen")
-
-    ws3.append(["Métrica", "Valor"])
-    ws3["A1"].font = header_font
-    ws3["B1"].font = header_font
-
-    total = len(sorted_results)
-    ws3.append(["Total empresas", total])
-
-    # Conteo por país
-    country_count = {}
-    for r in sorted_results:
-        c = r.get("pais", "Unknown")
-        country_count[c] = country_count.get(c, 0) + 1
-
-    ws3.append([])
-    ws3.append(["Empresas por país", ""])
-    for c, count in country_count.items():
-        ws3.append([c, count])
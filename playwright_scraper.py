@@ -1,45 +1,140 @@
 from __future__ import annotations
 
-from typing import List, Dict, Any, Tuple
-from playwright.sync_api import sync_playwright
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+from playwright.sync_api import Browser, Playwright, Route, sync_playwright
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
 
 
-def scrape_with_playwright(url: str, timeout_s: int = 30) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
-    results: List[Dict[str, Any]] = []
+# La API sync de Playwright queda ligada al hilo que la arranca: cada hilo del
+# pool tiene su propio Playwright + Chromium (thread-local) que sigue vivo
+# entre llamadas (cada scrape abre solo un context nuevo, mucho más barato).
+# El tamaño del pool limita cuántos fallbacks JS corren a la vez.
+_MAX_CONCURRENCY = max(1, int(os.environ.get("PLAYWRIGHT_MAX_CONCURRENCY", "4")))
+_EXECUTOR = ThreadPoolExecutor(max_workers=_MAX_CONCURRENCY, thread_name_prefix="playwright")
+_local = threading.local()
+# Opcional: endpoint CDP de un Chromium compartido (sidecar) para que varios
+# workers de uvicorn usen el mismo navegador en vez de lanzar uno cada uno.
+# Ej.: PLAYWRIGHT_CDP_URL=http://localhost:9222
+_CDP_URL = os.environ.get("PLAYWRIGHT_CDP_URL", "").strip()
+
+# Solo leemos texto de anchors: no descargamos imágenes, vídeo ni fuentes.
+# (Las hojas de estilo sí: innerText depende del CSS aplicado.)
+_BLOCKED_RESOURCE_TYPES = frozenset({"image", "media", "font"})
+# Analítica/ads: no aportan contenido y retrasan el reposo de red (networkidle)
+_BLOCKED_HOSTS_RE = re.compile(
+    r"^https?://[^/]*(?:doubleclick\.net|googletagmanager\.com|google-analytics\.com"
+    r"|googlesyndication\.com|connect\.facebook\.net|hotjar\.com)[:/]",
+    re.I,
+)
+
+# Filtro de longitud y dedupe (sin distinguir mayúsculas) dentro del navegador:
+# solo viajan por CDP los textos que vamos a devolver
+_ANCHOR_TEXTS_JS = """
+() => {
+  const seen = new Set();
+  const out = [];
+  for (const a of document.querySelectorAll('a')) {
+    const t = (a.innerText || '').trim();
+    if (t.length <= 3 || t.length >= 80) continue;
+    const k = t.toLowerCase();
+    if (seen.has(k)) continue;
+    seen.add(k);
+    out.push(t);
+  }
+  return out;
+}
+"""
+
+
+def _get_browser() -> Browser:
+    # Solo se llama desde los hilos de _EXECUTOR
+    browser: Optional[Browser] = getattr(_local, "browser", None)
+    if browser is None or not browser.is_connected():
+        pw: Optional[Playwright] = getattr(_local, "pw", None)
+        if pw is None:
+            pw = _local.pw = sync_playwright().start()
+        if _CDP_URL:
+            browser = pw.chromium.connect_over_cdp(_CDP_URL)
+        else:
+            # /dev/shm suele ser de 64MB en Docker: que Chromium use /tmp
+            browser = pw.chromium.launch(headless=True, args=["--disable-dev-shm-usage"])
+        _local.browser = browser
+    return browser
+
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
+def _block_heavy_resources(route: Route) -> None:
+    request = route.request
+    if request.resource_type in _BLOCKED_RESOURCE_TYPES or _BLOCKED_HOSTS_RE.match(request.url):
+        route.abort()
+    else:
+        route.continue_()
 
-        page.goto(url, timeout=timeout_s * 1000)
 
-        # Espera carga JS
-        page.wait_for_timeout(3000)
+def _close_browser(barrier: threading.Barrier) -> None:
+    try:
+        browser: Optional[Browser] = getattr(_local, "browser", None)
+        if browser is not None:
+            browser.close()
+            _local.browser = None
+        pw: Optional[Playwright] = getattr(_local, "pw", None)
+        if pw is not None:
+            pw.stop()
+            _local.pw = None
+    finally:
+        # Retenemos el hilo hasta que todos hayan cerrado: así cada tarea de
+        # cierre cae en un hilo distinto del pool
+        try:
+            barrier.wait(timeout=30)
+        except threading.BrokenBarrierError:
+            pass
 
-        html = page.content()
 
-        # Heurística básica: detectar posibles cards
-        elements = page.query_selector_all("a")
+def _scrape(url: str, timeout_s: int) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    context = _get_browser().new_context()
+    context.route("**/*", _block_heavy_resources)
+    try:
+        page = context.new_page()
 
-        seen = set()
+        # No esperamos al evento "load" (imágenes, trackers...): con el DOM listo basta
+        page.goto(url, wait_until="domcontentloaded", timeout=timeout_s * 1000)
 
-        for el in elements:
-            text = (el.inner_text() or "").strip()
-            if len(text) > 3 and len(text) < 80:
-                if text.lower() in seen:
-                    continue
-                seen.add(text.lower())
-                results.append({
-                    "fabricante": text,
-                    "actividad": "",
-                    "enlace_web": "",
-                    "pais": ""
-                })
+        # Espera carga JS: hasta que la red quede en reposo, con el mismo tope
+        # de 3s que antes (las páginas rápidas ya no esperan de más)
+        try:
+            page.wait_for_load_state("networkidle", timeout=3000)
+        except PlaywrightTimeoutError:
+            pass
 
-        browser.close()
+        # Heurística básica: detectar posibles cards. Un solo evaluate trae
+        # los textos ya filtrados y sin duplicados
+        texts: List[str] = page.evaluate(_ANCHOR_TEXTS_JS)
+        results: List[Dict[str, Any]] = [
+            {"fabricante": text, "actividad": "", "enlace_web": "", "pais": ""}
+            for text in texts
+        ]
+    finally:
+        context.close()
 
     return results, {
         "driver": "playwright",
         "supported": True,
         "note": "JS dynamic fallback"
     }
+
+
+def scrape_with_playwright(url: str, timeout_s: int = 30) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    return _EXECUTOR.submit(_scrape, url, timeout_s).result()
+
+
+def shutdown_playwright() -> None:
+    """
+    Cierra los navegadores de todos los hilos. Pensado para el apagado de la app.
+    """
+    barrier = threading.Barrier(_MAX_CONCURRENCY)
+    futures = [_EXECUTOR.submit(_close_browser, barrier) for _ in range(_MAX_CONCURRENCY)]
+    for f in futures:
+        f.result()
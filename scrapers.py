@@ -1,27 +1,39 @@
 from __future__ import annotations
 # scrapers.py
 from playwright_scraper import scrape_with_playwright
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypedDict
 from urllib.parse import urlparse
 
+import heapq
 import re
+import threading
+import time
+
 import requests
+from selectolax.parser import HTMLParser
 
 from easyfairs_widgets import (
-    is_easyfairs_supported,
     get_container_id_for_url,
-    fetch_easyfairs_stands_by_countries,
+    iter_easyfairs_stands_by_countries,
 )
 
 # -----------------------------
 # Tipos
 # -----------------------------
-Row = Dict[str, Any]
+class Row(TypedDict):
+    fabricante: str
+    actividad: str
+    enlace_web: str
+    pais: str
+
+
 Meta = Dict[str, Any]
 
 
-@dataclass
+@dataclass(slots=True)
 class ScrapeConfig:
     countries: List[str]
     lang: str = "es"
@@ -30,11 +42,23 @@ class ScrapeConfig:
     query_seed: str = "a"
     hits_per_page: int = 100
     debug: bool = False
+    container_id: Optional[int] = None  # si se conoce, salta la detección Easyfairs
 
 
 # -----------------------------
 # Helpers genéricos
 # -----------------------------
+_COUNTRY_MAP = {
+    "ES": "Spain",
+    "ESP": "Spain",
+    "ESPAÑA": "Spain",
+    "SPAIN": "Spain",
+    "PT": "Portugal",
+    "PRT": "Portugal",
+    "PORTUGAL": "Portugal",
+}
+
+
 def normalize_countries(countries: List[str]) -> List[str]:
     # Normaliza a nombres típicos en directorios internacionales
     if not countries:
@@ -43,26 +67,14 @@ def normalize_countries(countries: List[str]) -> List[str]:
     out: List[str] = []
     for c in countries:
         cc = (c or "").strip()
-        if not cc:
-            continue
-        u = cc.upper()
-        if u in ("ES", "ESP", "ESPAÑA", "SPAIN"):
-            out.append("Spain")
-        elif u in ("PT", "PRT", "PORTUGAL"):
-            out.append("Portugal")
-        else:
-            out.append(cc)
+        if cc:
+            out.append(_COUNTRY_MAP.get(cc.upper(), cc))
 
-    # dedupe
-    seen = set()
-    uniq = []
-    for x in out:
-        if x not in seen:
-            seen.add(x)
-            uniq.append(x)
-    return uniq
+    # dedupe manteniendo orden
+    return list(dict.fromkeys(out))
 
 
+@lru_cache(maxsize=4096)
 def _host(url: str) -> str:
     try:
         return (urlparse(url).netloc or "").lower()
@@ -70,24 +82,57 @@ def _host(url: str) -> str:
         return ""
 
 
+# URLs cuyo HTML estático se descargó bien (2xx) pero no dio filas, y que luego
+# sí resolvió Playwright: en scrapes posteriores de esa misma URL nos saltamos
+# el GET estático (que ya sabemos que no sirve).
+_PLAYWRIGHT_URLS_TTL_S = 3600
+_PLAYWRIGHT_URLS_MAX = 1024
+_PLAYWRIGHT_URLS: Dict[str, float] = {}  # url -> expira (time.monotonic)
+_PLAYWRIGHT_URLS_LOCK = threading.Lock()  # los endpoints sync corren en un threadpool
+
+
+def _is_playwright_url(url: str) -> bool:
+    with _PLAYWRIGHT_URLS_LOCK:
+        expires = _PLAYWRIGHT_URLS.get(url)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del _PLAYWRIGHT_URLS[url]
+            return False
+        return True
+
+
+def _remember_playwright_url(url: str) -> None:
+    with _PLAYWRIGHT_URLS_LOCK:
+        _PLAYWRIGHT_URLS.pop(url, None)
+        if len(_PLAYWRIGHT_URLS) >= _PLAYWRIGHT_URLS_MAX:
+            # dict mantiene orden de inserción: fuera la entrada más antigua
+            del _PLAYWRIGHT_URLS[next(iter(_PLAYWRIGHT_URLS))]
+        _PLAYWRIGHT_URLS[url] = time.monotonic() + _PLAYWRIGHT_URLS_TTL_S
+
+
+def _forget_playwright_url(url: str) -> None:
+    with _PLAYWRIGHT_URLS_LOCK:
+        _PLAYWRIGHT_URLS.pop(url, None)
+
+
 # -----------------------------
 # Driver 1: Easyfairs
 # -----------------------------
-def scrape_easyfairs(url: str, cfg: ScrapeConfig) -> Tuple[List[Row], Meta]:
-    if not is_easyfairs_supported(url):
-        return [], {"supported": False, "driver": "easyfairs"}
-
-    container_id = get_container_id_for_url(url)
+def scrape_easyfairs(
+    url: str,
+    cfg: ScrapeConfig,
+    on_empty_first_page: Optional[Callable[[], None]] = None,
+) -> Tuple[List[Row], Meta]:
+    # Un único lookup (cacheado): sin containerId no hay driver Easyfairs
+    container_id = cfg.container_id or get_container_id_for_url(url)
     if not container_id:
-        return [], {
-            "supported": False,
-            "driver": "easyfairs",
-            "reason": "domain supported pero sin containerId mapping",
-        }
+        return [], {"supported": False, "driver": "easyfairs"}
 
     countries_norm = normalize_countries(cfg.countries)
 
-    rows, meta = fetch_easyfairs_stands_by_countries(
+    meta: Meta = {}
+    stands = iter_easyfairs_stands_by_countries(
         event_url=url,
         container_id=container_id,
         countries=countries_norm,
@@ -96,22 +141,24 @@ def scrape_easyfairs(url: str, cfg: ScrapeConfig) -> Tuple[List[Row], Meta]:
         hits_per_page=cfg.hits_per_page,
         timeout_s=cfg.timeout_s,
         max_pages=cfg.max_pages if cfg.max_pages > 0 else None,
+        meta=meta,
+        on_empty_first_page=on_empty_first_page,
     )
 
-    # Normalizamos al “modelo” de tu API
-    out: List[Row] = []
-    for r in rows:
-        out.append(
-            {
-                "fabricante": r.get("name", "") or "",
-                "actividad": r.get("activity", "") or "",
-                "enlace_web": r.get("website", "") or "",
-                "pais": r.get("country", "") or "",
-            }
+    # Normalizamos al “modelo” de tu API según llegan las páginas
+    # (sin lista intermedia de stands)
+    out: List[Row] = [
+        Row(
+            fabricante=r.get("name") or "",
+            actividad=r.get("activity") or "",
+            enlace_web=r.get("website") or "",
+            pais=r.get("country") or "",
         )
+        for r in stands
+    ]
 
     meta2: Meta = {"driver": "easyfairs", "supported": True}
-    meta2.update(meta or {})
+    meta2.update(meta)
     return out, meta2
 
 
@@ -120,17 +167,98 @@ def scrape_easyfairs(url: str, cfg: ScrapeConfig) -> Tuple[List[Row], Meta]:
 # - Útil para directorios sencillos que tienen cards con nombre/país/web
 # - No es universal, pero sirve como “segundo intento”
 # -----------------------------
-_NAME_PATTERNS = [
-    re.compile(r'exhibitor|exhibitors|expositor|expositores|companies|empresas', re.I),
-]
+# Una sola alternativa: "exhibitors"/"expositores" ya contienen su singular
+# (en bytes: se busca sobre el body según llega, antes de decodificar)
+_EXHIBITORS_RE = re.compile(rb"exhibitor|expositor|companies|empresas", re.I)
+# Textos de menú típicos: una sola pasada del regex en vez de un `in` por palabra
+_MENU_RE = re.compile(r"home|inicio|about|contact|privacy|cookies", re.I)
+
+# Si en los primeros 256KB no aparece ningún marcador, no es un directorio:
+# cortamos la descarga en vez de bajar la página entera para descartarla.
+_MARKER_SCAN_LIMIT = 256 * 1024
+_MARKER_OVERLAP = 8  # len("expositor") - 1: marcador partido entre dos chunks
+
+
+def _read_exhibitors_page(r: requests.Response) -> Tuple[bytes, bool]:
+    """
+    Lee el body en streaming. Devuelve (bytes leídos, ¿hay marcador?); si no
+    aparece ninguno en los primeros _MARKER_SCAN_LIMIT bytes no lee el resto.
+    """
+    buf = bytearray()
+    found = False
+    for chunk in r.iter_content(chunk_size=16384):
+        start = max(0, len(buf) - _MARKER_OVERLAP)
+        buf += chunk
+        if not found:
+            found = _EXHIBITORS_RE.search(buf, start) is not None
+            if not found and len(buf) >= _MARKER_SCAN_LIMIT:
+                break
+    return bytes(buf), found
+
+
+# Página "estática de verdad": pocos <script> y el contenido ya en los <a>.
+# Si el HTML estático no sirvió y no es JS pesado, Playwright no va a ver más.
+_SCRIPT_TAG_RE = re.compile(rb"<script\b", re.I)
+_ANCHOR_TAG_RE = re.compile(rb"<a\s", re.I)
+_JS_HEAVY_MAX_SCRIPTS = 20
+_JS_HEAVY_MIN_ANCHORS = 20
+
+
+def _looks_js_heavy(body: bytes) -> bool:
+    scripts = sum(1 for _ in _SCRIPT_TAG_RE.finditer(body))
+    if scripts > _JS_HEAVY_MAX_SCRIPTS:
+        return True
+    anchors = sum(1 for _ in _ANCHOR_TAG_RE.finditer(body))
+    return anchors < _JS_HEAVY_MIN_ANCHORS
+
+
+# Sesión propia del driver estático: keep-alive entre scrapes del mismo host
+_STATIC_SESSION = requests.Session()
+_STATIC_SESSION.headers.update(
+    {
+        "user-agent": "Mozilla/5.0",
+        "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    }
+)
+
+# Validadores HTTP por URL: si el servidor responde 304 reutilizamos las filas
+# ya extraídas sin descargar ni parsear de nuevo.
+_STATIC_CACHE_MAX = 256
+_STATIC_CACHE: Dict[str, Tuple[str, str, List[Row]]] = {}  # url -> (etag, last-modified, filas)
+_STATIC_CACHE_LOCK = threading.Lock()
+
+
+def _static_cache_get(url: str) -> Optional[Tuple[str, str, List[Row]]]:
+    with _STATIC_CACHE_LOCK:
+        return _STATIC_CACHE.get(url)
+
+
+def _static_cache_put(url: str, etag: str, last_modified: str, rows: List[Row]) -> None:
+    if not (etag or last_modified):
+        return
+    with _STATIC_CACHE_LOCK:
+        _STATIC_CACHE.pop(url, None)
+        if len(_STATIC_CACHE) >= _STATIC_CACHE_MAX:
+            # dict mantiene orden de inserción: fuera la entrada más antigua
+            del _STATIC_CACHE[next(iter(_STATIC_CACHE))]
+        _STATIC_CACHE[url] = (etag, last_modified, rows)
+
 
-def _looks_like_exhibitors_page(html: str) -> bool:
-    if not html:
-        return False
-    for p in _NAME_PATTERNS:
-        if p.search(html):
-            return True
-    return False
+def _decode(data: bytes, encoding: str) -> str:
+    try:
+        return data.decode(encoding, errors="replace")
+    except LookupError:  # charset desconocido en la cabecera
+        return data.decode("utf-8", errors="replace")
+
+
+def _decode_undeclared(data: bytes) -> str:
+    # Sin charset en la cabecera: UTF-8 si es válido; si no, cp1252 (superset
+    # de Latin-1, habitual en webs ES/PT antiguas). No se pasan bytes crudos a
+    # selectolax: con Latin-1 sin <meta> descarta los acentos.
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("cp1252", errors="replace")
 
 
 def scrape_static_html(url: str, cfg: ScrapeConfig) -> Tuple[List[Row], Meta]:
@@ -140,67 +268,131 @@ def scrape_static_html(url: str, cfg: ScrapeConfig) -> Tuple[List[Row], Meta]:
     - o listas con items
     Este driver NO garantiza éxito; es fallback.
     """
-    headers = {
-        "user-agent": "Mozilla/5.0",
-        "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-    }
+    cached = _static_cache_get(url)
+    headers: Dict[str, str] = {}
+    if cached is not None:
+        if cached[0]:
+            headers["if-none-match"] = cached[0]
+        if cached[1]:
+            headers["if-modified-since"] = cached[1]
+
     try:
-        r = requests.get(url, headers=headers, timeout=cfg.timeout_s)
+        with _STATIC_SESSION.get(url, headers=headers, timeout=cfg.timeout_s, stream=True) as r:
+            if r.status_code == 304 and cached is not None:
+                rows = list(cached[2])
+                return rows, {
+                    "driver": "static_html",
+                    "supported": True,
+                    "note": "fallback heurístico; puede incluir falsos positivos",
+                    "count_candidates": len(rows),
+                    "http_status": 304,
+                }
+            if r.status_code >= 400:
+                return [], {
+                    "driver": "static_html",
+                    "supported": False,
+                    "http_status": r.status_code,
+                    "body_preview": (r.text or "")[:400],
+                }
+            body, found = _read_exhibitors_page(r)
+            # requests asume ISO-8859-1 si no hay charset: solo nos fiamos del explícito
+            content_type = (r.headers.get("content-type") or "").lower()
+            charset = r.encoding if "charset=" in content_type else None
+            etag = r.headers.get("etag") or ""
+            last_modified = r.headers.get("last-modified") or ""
     except Exception as e:
         return [], {"driver": "static_html", "supported": False, "error": str(e)}
 
-    if r.status_code >= 400:
+    if not found:
         return [], {
             "driver": "static_html",
             "supported": False,
-            "http_status": r.status_code,
-            "body_preview": (r.text or "")[:400],
+            "reason": "no parece directorio",
+            "js_heavy": _looks_js_heavy(body),
         }
 
-    html = r.text or ""
-    if not _looks_like_exhibitors_page(html):
-        return [], {"driver": "static_html", "supported": False, "reason": "no parece directorio"}
+    html = _decode(body, charset) if charset else _decode_undeclared(body)
 
     # Heurística MUY conservadora: buscar anchors con texto “largo” como posible nombre
     # y quedarnos con un conjunto único.
     candidates = set()
-    for m in re.finditer(r"<a[^>]*>([^<]{2,120})</a>", html, flags=re.I):
-        text = re.sub(r"\s+", " ", (m.group(1) or "").strip())
+    # Parser HTML real (C): anchors multilínea o con tags anidados
+    # (<a><span>ACME</span> <b>Corp</b></a>) también cuentan
+    for node in HTMLParser(html).css("a"):
+        # split()/join colapsa espacios y recorta sin pasar por el motor de regex
+        text = " ".join(node.text(separator=" ").split())
         if 3 <= len(text) <= 80:
             # evitamos menús típicos
-            if any(x in text.lower() for x in ["home", "inicio", "about", "contact", "privacy", "cookies"]):
+            if _MENU_RE.search(text):
                 continue
             candidates.add(text)
 
     # Convertimos a rows sin país (no siempre hay)
     results: List[Row] = []
-    for name in sorted(candidates)[:2000]:
+    # nsmallest: solo ordenamos lo que devolvemos, no todos los candidatos
+    for name in heapq.nsmallest(2000, candidates):
         results.append({"fabricante": name, "actividad": "", "enlace_web": "", "pais": ""})
 
-    return results, {
+    if results:
+        _static_cache_put(url, etag, last_modified, list(results))
+
+    meta: Meta = {
         "driver": "static_html",
         "supported": True,
         "note": "fallback heurístico; puede incluir falsos positivos",
         "count_candidates": len(results),
     }
+    if not results:
+        # Solo interesa para decidir el fallback Playwright (scrape_any)
+        meta["js_heavy"] = _looks_js_heavy(body)
+    return results, meta
 
 
 # -----------------------------
 # Autodetección: orden de preferencia
 # -----------------------------
+# Hilos para adelantar el driver estático cuando Easyfairs empieza vacío
+_STATIC_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="static-html")
+
+
 def scrape_any(url: str, cfg: ScrapeConfig) -> Tuple[List[Row], Meta]:
+    host = _host(url)
+    skipped_static = _is_playwright_url(url)
+
+    # El GET estático solo se adelanta si la primera página de Easyfairs vuelve
+    # vacía: se solapa con el resto del driver sin duplicar peticiones en el
+    # caso normal. (Si otro país sí trae hits, ese GET se desperdicia.)
+    static_future: Optional[Future] = None
+
+    def prefetch_static() -> None:
+        nonlocal static_future
+        if static_future is None:
+            static_future = _STATIC_EXECUTOR.submit(scrape_static_html, url, cfg)
+
     # 1) Easyfairs (rápido y preciso)
-    res, meta = scrape_easyfairs(url, cfg)
+    res, meta = scrape_easyfairs(
+        url, cfg, on_empty_first_page=None if skipped_static else prefetch_static
+    )
     if meta.get("supported") and res:
         return res, meta
 
-    # 2) HTML estático (fallback)
-    res2, meta2 = scrape_static_html(url, cfg)
-    if meta2.get("supported") and res2:
-        # Añadimos info del intento anterior si debug
-        if cfg.debug:
-            meta2["previous_driver"] = meta
-        return res2, meta2
+    # 2) HTML estático (fallback), salvo que esta URL ya se resolviera con JS
+    if skipped_static:
+        meta2 = {
+            "driver": "static_html",
+            "supported": False,
+            "reason": "omitido: URL resuelta antes con playwright",
+        }
+    else:
+        if static_future is not None:
+            res2, meta2 = static_future.result()
+        else:
+            res2, meta2 = scrape_static_html(url, cfg)
+        if meta2.get("supported") and res2:
+            # Añadimos info del intento anterior si debug
+            if cfg.debug:
+                meta2["previous_driver"] = meta
+            return res2, meta2
 
     # 3) Si quieres: aquí es donde meterías un driver Playwright (JS)
     #    Lo dejo preparado para que lo añadamos cuando tú quieras.
@@ -210,10 +402,23 @@ def scrape_any(url: str, cfg: ScrapeConfig) -> Tuple[List[Row], Meta]:
         "supported": False,
         "reason": "No se detectó un driver soportado o no se obtuvieron resultados",
         "attempts": [meta, meta2],
-        "host": _host(url),
+        "host": host,
     }
-    # 3) Playwright fallback (JS dinámico)
+    # 3) Playwright fallback (JS dinámico), solo si el HTML estático pinta a
+    #    página renderizada con JS (sin dato -error HTTP, omitido- se intenta)
+    if meta2.get("js_heavy") is False:
+        meta_out["playwright"] = "omitido: HTML estático sin indicios de contenido JS"
+        return [], meta_out
+
     res3, meta3 = scrape_with_playwright(url, timeout_s=cfg.timeout_s)
     if res3:
+        # Solo si el estático terminó bien y sin filas: un error transitorio
+        # (timeout, conexión, 5xx) no significa que la página necesite JS
+        if not skipped_static and "error" not in meta2 and "http_status" not in meta2:
+            _remember_playwright_url(url)
         return res3, meta3
+
+    # La entrada cacheada ya no vale: la próxima vez se vuelve a probar todo
+    if skipped_static:
+        _forget_playwright_url(url)
     return [], meta_out